@@ -2,7 +2,7 @@
 
 import itertools as it, operator as op, functools as ft
 from datetime import datetime
-import re, json
+import json
 
 from twisted.internet import reactor, defer
 
@@ -10,7 +10,7 @@ from allmydata.node import InvalidValueError, MissingConfigEntry
 from allmydata.util import log
 
 from .pubcloud_common import (
-	encode_key, decode_key,
+	encode_key, decode_key, private_config_writer,
 	PubCloudItem, PubCloudListing, PubCloudContainer )
 
 
@@ -33,7 +33,7 @@ def configure_boxdotnet_container(storedir, config):
 			' See "Authorization" section in "doc/cloud.rst" for details.\n\n'
 			' URL to visit: {}\n'.format(api.auth_user_get_url()) )
 
-	if re.search(r'^https?://', auth_code):
+	if auth_code.startswith(('http://', 'https://')):
 		api = txBox(client_id=client_id, client_secret=client_secret)
 		api.auth_user_process_url(auth_code)
 		auth_code = api.auth_code
@@ -82,9 +82,13 @@ def configure_boxdotnet_container(storedir, config):
 	else:
 		folder_id_created = False
 
+	# Tokens can get refreshed in bursts, which shouldn't cause a disk write each
+	token_write = private_config_writer(config, {
+		'box_access_token': access_token, 'box_refresh_token': refresh_token })
+
 	def token_update_handler(auth_access_token, auth_refresh_token, **kwargs):
-		config.write_private_config('box_access_token', auth_access_token)
-		config.write_private_config('box_refresh_token', auth_refresh_token)
+		token_write('box_access_token', auth_access_token)
+		token_write('box_refresh_token', auth_refresh_token)
 		if kwargs:
 			log.msg( 'Received unhandled box.net access'
 				' data, discarded: {}'.format(', '.join(kwargs.keys())), level=log.WEIRD )
@@ -200,11 +204,9 @@ class BoxContainer(PubCloudContainer):
 
 		info['size'] = len(data)
 		info['content_modified_at'] = datetime.utcnow().isoformat()
-		self._chunks[key] = self._chunks[info['id']] = BoxItem(info, key=key)
+		self._chunks_set(key, BoxItem(info, key=key))
 
 
-	@defer.inlineCallbacks
 	def delete_object(self, key):
-		chunk_id = self._chunks[key].backend_id
-		yield self._do_request('delete', self.client.delete_file, chunk_id)
-		del self._chunks[key], self._chunks[chunk_id]
+		return self._do_request('delete', self.client.delete_file, self._chunks[key].backend_id)\
+			.addCallback(self._chunks_del_callback, key)
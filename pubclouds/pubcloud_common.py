@@ -3,10 +3,12 @@
 import itertools as it, operator as op, functools as ft
 from time import time
 from collections import deque
-import re, json
+from binascii import hexlify
+from bisect import bisect_left
+import re, json, random
 
 from zope.interface import implements
-from twisted.internet import reactor, defer, task
+from twisted.internet import reactor, defer, task, threads
 from twisted.web import http
 
 from allmydata.node import InvalidValueError, MissingConfigEntry
@@ -37,12 +39,16 @@ class ContainerRateLimitMixin(object):
 	# Uses/expects container._reactor attribute set for the object
 	# TODO: generic IMixin with fixed _do_request method
 
-	rate_errors = 420,
+	rate_errors = 420, 429
 	retry_backoff = 60, 120, 120, 600
+	retry_jitter = 0.5 # randomize delays by +/- this fraction, so retries won't come in bursts
 
 	def __init__(self, interval, burst):
 		if interval <= 0 or burst <= 0: # no limit
 			self.bucket = None
+			# Skip per-call partial/super/bucket-check from _do_request method entirely
+			self._do_request = ft.partial( self._rate_limit_retries,
+				super(ContainerRateLimitMixin, self)._do_request )
 			return
 		self.bucket = token_bucket(interval, burst)
 		next(self.bucket)
@@ -52,15 +58,15 @@ class ContainerRateLimitMixin(object):
 		self._reactor.callLater(seconds, d.callback, None)
 		return d
 
-	@defer.inlineCallbacks
 	def _do_request(self, *argz, **kwz):
+		# Not using inlineCallbacks here, as it'd only wrap deferred from func() into another one
 		func = ft.partial( self._rate_limit_retries,
 			super(ContainerRateLimitMixin, self)._do_request, *argz, **kwz )
-		if not self.bucket: defer.returnValue((yield func()))
-		delay = next(self.bucket)
-		if delay is None: defer.returnValue((yield func()))
-		yield self._delay(delay)
-		defer.returnValue((yield func()))
+		if self.bucket:
+			delay = next(self.bucket)
+			if delay is not None:
+				return self._delay(delay).addCallback(lambda ign: func())
+		return func()
 
 	@defer.inlineCallbacks
 	def _rate_limit_retries(self, func, *argz, **kwz):
@@ -72,6 +78,8 @@ class ContainerRateLimitMixin(object):
 				' a delay'.format(err.args[1], err.args[2]), level=log.OPERATIONAL )
 		# Do it the hard way
 		for attempt, delay in enumerate(self.retry_backoff, 1):
+			if self.retry_jitter:
+				delay *= random.uniform(1 - self.retry_jitter, 1 + self.retry_jitter)
 			yield self._delay(delay)
 			try: defer.returnValue((yield func(*argz, **kwz)))
 			except CloudError as err:
@@ -79,13 +87,57 @@ class ContainerRateLimitMixin(object):
 					or attempt == len(self.retry_backoff): raise
 
 
+def private_config_writer(config, values=None, delay=0.5):
+	'''Returns write(name, value) function for private config values,
+		which skips unchanged ones and batches updates done within "delay"
+		into one write, done from a thread (in order) to not block the reactor.'''
+	state, pending, writes = dict(values or dict()), dict(), [defer.succeed(None)]
+
+	def _write(updates):
+		for k, v in updates.viewitems(): config.write_private_config(k, v)
+
+	def _write_error(err, updates):
+		log.msg( 'Failed to store private config values'
+			' ({}): {}'.format(', '.join(updates), err.getErrorMessage()), level=log.WEIRD )
+		# Make sure same values won't be skipped as "unchanged" on next update
+		for k, v in updates.viewitems():
+			if state.get(k) == v: del state[k]
+
+	def _flush():
+		if not pending: return
+		updates = pending.copy()
+		pending.clear()
+		writes[0] = writes[0]\
+			.addCallback(lambda ign: threads.deferToThread(_write, updates))\
+			.addErrback(_write_error, updates)
+
+	def _flush_on_shutdown():
+		# Delayed _flush won't run on reactor stop, so do it now and make shutdown wait for it
+		_flush()
+		d = defer.Deferred()
+		writes[0].addCallback(lambda ign: d.callback(None))
+		return d
+	reactor.addSystemEventTrigger('before', 'shutdown', _flush_on_shutdown)
+
+	def write(name, value):
+		if state.get(name) == value: return
+		if not pending: reactor.callLater(delay, _flush)
+		state[name] = pending[name] = value
+
+	return write
+
+
 def encode_key(key):
 	return key.replace('_', '__').replace('/', '_')
 
+def decode_key_bytes(key_enc):
+	# Inverse of encode_key, using nul (never present in names) as a placeholder for "__"
+	return key_enc.replace('__', '\0').replace('_', '/').replace('\0', '_')
+
 def decode_key(key_enc):
 	if isinstance(key_enc, unicode):
 		key_enc = key_enc.encode('utf-8')
-	return '__'.join(c.replace('_', '/') for c in key_enc.split('__'))
+	return decode_key_bytes(key_enc)
 
 
 
@@ -131,8 +183,10 @@ class PubCloudContainer(ContainerRateLimitMixin, ContainerRetryMixin):
 
 	def __init__(self, tb_interval=None, tb_burst=None, override_reactor=None):
 		self._reactor = override_reactor or reactor
-		self._chunks_lock = defer.DeferredLock()
 		self._chunks_flush()
+		# Pre-bound callbacks, used on every list_objects/delete_object call
+		self._list_objects_build = self._list_objects_build
+		self._chunks_del_callback = self._chunks_del_callback
 		super(PubCloudContainer, self).__init__(interval=tb_interval, burst=tb_burst)
 
 		attrs = self.ProtocolError, self.DoesNotExists, self.ServiceError
@@ -166,8 +220,8 @@ class PubCloudContainer(ContainerRateLimitMixin, ContainerRetryMixin):
 		#  whole shares dir will be scanned recursively and all file-id's recorded.
 		# original key = shares/$PREFIX/$STORAGEINDEX/$SHNUM.$CHUNK
 		if self.folder_buckets == 1: return prefix # don't make any subfolders
-		hn, h = 0, self._key_hash(key).digest()
-		for b in h: hn = (hn << 8) + ord(b)
+		h = self._key_hash(key).digest()
+		hn = int(hexlify(h), 16) # same as per-byte shift-add loop, but in C
 		if hn > self._key_hash_max: # avoid bias by +1 hashing
 			return self.key_bucket(h)
 		return self.fjoin( prefix,
@@ -254,17 +308,48 @@ class PubCloudContainer(ContainerRateLimitMixin, ContainerRetryMixin):
 	_chunks = None # {file_id1: info1, file_key1: info1, ...}
 	_chunks_misplaced = None # {key: file_id, ...}
 	_folds = None # {fold: folder_id, ...}
+	_list_cache = None # {prefix: [item1, item2, ...], ...}, prefixes dropped on matching key changes
+	_list_cache_stale = None # [key1, key2, ...] changed since last _list_chunks call
+	_list_cache_stale_max = 1000 # whole cache is dropped instead of tracking more changes
+	_list_index = None # ([key1, key2, ...], [item1, item2, ...]) - sorted by key, no id entries
 
 	def _chunks_flush(self):
 		self._chunks = self._chunks_misplaced = self._folds = None
-
-	@defer.inlineCallbacks
-	def _first_result(self, *deferreds):
-		try:
-			res, idx = yield defer.DeferredList(
-				deferreds, fireOnOneCallback=True, fireOnOneErrback=True )
-		except defer.FirstError as err: err.subFailure.raiseException()
-		defer.returnValue(res)
+		self._list_cache = self._list_index = None
+
+	def _chunks_set(self, key, item):
+		self._chunks[key] = self._chunks[item.backend_id] = item
+		self._list_index_update(key, item)
+		self._list_cache_evict(key)
+
+	def _chunks_del(self, key):
+		item = self._chunks.pop(key)
+		del self._chunks[item.backend_id]
+		self._list_index_update(key)
+		self._list_cache_evict(key)
+
+	def _chunks_del_callback(self, res, key):
+		self._chunks_del(key)
+
+	def _list_cache_evict(self, key):
+		# Only listings that can include the key are dropped, others stay valid.
+		# Actual eviction is done on next _list_chunks call, keeping put/delete paths cheap.
+		if not self._list_cache: return
+		if len(self._list_cache_stale) >= self._list_cache_stale_max: self._list_cache = None
+		else: self._list_cache_stale.append(key)
+
+	def _list_index_update(self, key, item=None):
+		# Keeps sorted index in sync with changes, so that it'd never need full re-sort
+		if self._list_index is None: return
+		keys, items = self._list_index
+		n = bisect_left(keys, key)
+		found = n < len(keys) and keys[n] == key
+		if item is None:
+			if found: del keys[n], items[n]
+		elif found: items[n] = item
+		else:
+			keys.insert(n, key)
+			items.insert(n, item)
 
 	@defer.inlineCallbacks
 	def _crawl_fold(self, fold, info):
@@ -281,31 +366,35 @@ class PubCloudContainer(ContainerRateLimitMixin, ContainerRetryMixin):
 		chunks, folds = list(), {'': self.folder_id}
 		lst = deque( ('', info) for info in (yield self._mkdir_wrapper(
 			lambda: self._do_request('list root', self._listdir, self.folder_id) )) )
-		lst_futures = dict()
+		# Subdir listings (or failures) get queued as they finish, in any order
+		lst_done, lst_pending = defer.DeferredQueue(), 0
 
-		while lst or lst_futures:
+		while lst or lst_pending:
 			try: fold, info = lst.popleft()
 			except IndexError:
-				fold, sublst = yield self._first_result(*lst_futures.viewvalues())
+				fold, sublst = yield lst_done.get()
 				lst.extend(sublst)
-				del lst_futures[fold]
+				lst_pending -= 1
 				continue
 
 			if info['type'] == 'folder':
 				fold = self.fjoin(fold, info['name'])
 				folds[fold] = info['id']
-				lst_futures[fold] = self._crawl_fold(fold, info)
+				self._crawl_fold(fold, info).addBoth(lst_done.put)
+				lst_pending += 1
 			else: chunks.append((fold, info))
 
 		defer.returnValue((chunks, folds))
 
 	@defer.inlineCallbacks
 	def _chunks_find(self):
-		chunk_list, self._folds = yield self._crawl()
-		self._chunks_misplaced = dict()
-		duplicate_debug, chunks = dict(), dict()
+		# All maps are built in local vars and swapped-in at once at the end,
+		#  so that nothing can see (or update) partially-built state in-between
+		chunk_list, folds = yield self._crawl()
+		duplicate_debug, chunks, chunks_misplaced = dict(), dict(), dict()
 		for fold, info in chunk_list:
-			key, cid = decode_key(info['name']), info['id']
+			# Names always come from json here, so are known to be unicode
+			key, cid = decode_key_bytes(info['name'].encode('utf-8')), info['id']
 
 			# Detect various duplicates
 			if key in chunks:
@@ -333,25 +422,62 @@ class PubCloudContainer(ContainerRateLimitMixin, ContainerRetryMixin):
 				## These are somewhat important, but way too noisy on *.folder_buckets update
 				# log.msg(( 'Detected share (key: {}) in an unexpected folder:'
 				# 	' {} (expected: {})' ).format(key, fold, fold_expected), level=log.UNUSUAL )
-				self._chunks_misplaced[key] = fold, cid
+				chunks_misplaced[key] = fold, cid
 
 			duplicate_debug[key] = fold, info # kept here for debug messages only
 			chunks[key] = chunks[cid] = self.build_item(info, key=key)
-		self._chunks = chunks
+		self._chunks, self._chunks_misplaced, self._folds = chunks, chunks_misplaced, folds
+		self._list_cache = self._list_index = None
 
 
-	@defer.inlineCallbacks
+	_chunks_waiters = None # [deferred1, deferred2, ...], while _chunks_find is in progress
+
+	def _chunks_ready(self):
+		# All concurrent callers share one _chunks_find run,
+		#  and get fired together (in FIFO order) when it's done.
+		if self._chunks_waiters is None and self._chunks is not None:
+			return defer.succeed(None)
+		d = defer.Deferred()
+		if self._chunks_waiters is not None: self._chunks_waiters.append(d)
+		else:
+			self._chunks_waiters = [d]
+			self._chunks_find().addBoth(self._chunks_ready_fire)
+		return d
+
+	def _chunks_ready_fire(self, res):
+		waiters, self._chunks_waiters = self._chunks_waiters, None
+		for d in waiters: d.callback(res)
+
 	def list_objects(self, prefix=''):
-		yield self._chunks_lock.acquire()
-		try:
-			if self._chunks is None:
-				yield self._chunks_find()
-		finally: self._chunks_lock.release()
-		defer.returnValue(
-			self.build_listing(self.folder_name, prefix, list(
-				item for key, item in self._chunks.viewitems()
-				if key != item.backend_id\
-					and (not prefix or key.startswith(prefix)) )) )
+		# Common case of already-built index doesn't need any Deferred chains
+		if self._chunks is None:
+			return self._chunks_ready().addCallback(self._list_objects_build, prefix)
+		return defer.succeed(self._list_objects_build(None, prefix))
+
+	def _list_objects_build(self, ign, prefix):
+		return self.build_listing(self.folder_name, prefix, list(self._list_chunks(prefix)))
+
+	def _list_chunks(self, prefix=''):
+		# Sorted keys/items lists (skipping id entries) are built once per crawl and updated
+		#  in-place, prefix listings are sliced from these, cached until matching key changes.
+		if self._list_cache is None: self._list_cache, self._list_cache_stale = dict(), list()
+		elif self._list_cache_stale:
+			keys, self._list_cache_stale = self._list_cache_stale, list()
+			prefix_lens = set(it.imap(len, self._list_cache))
+			for key in keys:
+				for n in prefix_lens: self._list_cache.pop(key[:n], None)
+		try: return self._list_cache[prefix]
+		except KeyError: pass
+		if self._list_index is None:
+			keys = sorted(key for key, item in self._chunks.viewitems() if key != item.backend_id)
+			self._list_index = keys, map(self._chunks.__getitem__, keys)
+		keys, items = self._list_index
+		if prefix:
+			n = n0 = bisect_left(keys, prefix)
+			while n < len(keys) and keys[n].startswith(prefix): n += 1
+			items = items[n0:n]
+		self._list_cache[prefix] = items
+		return items
 
 
 	def put_object(self, key, data, content_type=None, metadata=None):
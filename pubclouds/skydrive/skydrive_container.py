@@ -2,7 +2,6 @@
 
 import itertools as it, operator as op, functools as ft
 from datetime import datetime
-import re
 
 from twisted.internet import reactor, defer
 
@@ -10,7 +9,7 @@ from allmydata.node import InvalidValueError, MissingConfigEntry
 from allmydata.util import log
 
 from .pubcloud_common import (
-	encode_key, decode_key,
+	encode_key, decode_key, private_config_writer,
 	PubCloudItem, PubCloudListing, PubCloudContainer )
 
 
@@ -33,7 +32,7 @@ def configure_skydrive_container(storedir, config):
 			' See "Authorization" section in "doc/cloud.rst" for details.\n\n'
 			' URL to visit: {}\n'.format(api.auth_user_get_url()) )
 
-	if re.search(r'^https?://', auth_code):
+	if auth_code.startswith(('http://', 'https://')):
 		api = txSkyDrive(client_id=client_id, client_secret=client_secret)
 		api.auth_user_process_url(auth_code)
 		auth_code = api.auth_code
@@ -83,9 +82,13 @@ def configure_skydrive_container(storedir, config):
 	else:
 		folder_id_created = False
 
+	# Tokens can get refreshed in bursts, which shouldn't cause a disk write each
+	token_write = private_config_writer(config, {
+		'skydrive_access_token': access_token, 'skydrive_refresh_token': refresh_token })
+
 	def token_update_handler(auth_access_token, auth_refresh_token, **kwargs):
-		config.write_private_config('skydrive_access_token', auth_access_token)
-		config.write_private_config('skydrive_refresh_token', auth_refresh_token)
+		token_write('skydrive_access_token', auth_access_token)
+		token_write('skydrive_refresh_token', auth_refresh_token)
 		if kwargs:
 			log.msg( 'Received unhandled SkyDrive access'
 				' data, discarded: {}'.format(', '.join(kwargs.keys())), level=log.WEIRD )
@@ -181,11 +184,9 @@ class SkyDriveContainer(PubCloudContainer):
 
 		info['size'] = len(data)
 		info['updated_time'] = datetime.utcnow().isoformat()
-		self._chunks[key] = self._chunks[info['id']] = self.build_item(info, key=key)
+		self._chunks_set(key, self.build_item(info, key=key))
 
 
-	@defer.inlineCallbacks
 	def delete_object(self, key):
-		chunk_id = self._chunks[key].backend_id
-		yield self._do_request('delete', self.client.delete, chunk_id)
-		del self._chunks[key], self._chunks[chunk_id]
+		return self._do_request('delete', self.client.delete, self._chunks[key].backend_id)\
+			.addCallback(self._chunks_del_callback, key)
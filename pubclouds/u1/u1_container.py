@@ -180,13 +180,11 @@ class U1Container(PubCloudContainer):
 			yield self._do_request('delete duplicate chunk', self.client.node_delete, info_dup['path'])
 			del self._chunks[cid_dup], self._chunks_misplaced[key]
 
-		self._chunks[key] = self._chunks[item.backend_id] = item
+		self._chunks_set(key, item)
 
-	@defer.inlineCallbacks
 	def delete_object(self, key):
-		item = self._chunks[key]
-		yield self._do_request('delete', self.client.node_delete, item.path)
-		del self._chunks[key], self._chunks[item.backend_id]
+		return self._do_request('delete', self.client.node_delete, self._chunks[key].path)\
+			.addCallback(self._chunks_del_callback, key)
 
 
 	def get_object(self, key):